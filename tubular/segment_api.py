@@ -1,22 +1,54 @@
 """
 Segment API call wrappers
 """
+import concurrent.futures
+import hashlib
+import json
 import logging
+import operator
 import sys
+import threading
+import time
 import traceback
+from email.utils import parsedate_to_datetime
 
 import backoff
 import requests
 from simplejson.errors import JSONDecodeError
-from six import text_type
+
+from tubular.exception import BackendDataError, TimeoutException
 
 # Maximum number of tries on Segment API calls
 MAX_TRIES = 4
 
+# Longest Retry-After (in seconds) we will wait on. Retries give up on rate limits declaring longer waits,
+# and bulk deletion status polling waits at most this long between polls.
+MAX_RETRY_AFTER_SECONDS = 300
+
+# backoff 2.x primes wait generators before the first call and then sends them each exception being retried.
+# The backoff 1.x pinned for Python 3.5 only calls next() from inside its exception handler, where the
+# exception being retried is available from sys.exc_info() instead.
+_BACKOFF_SENDS_EXCEPTIONS = int(backoff.__version__.split('.')[0]) >= 2
+
 # These are the required/optional keys in the learner dict that contain IDs we need to retire from Segment.
 REQUIRED_IDENTIFYING_KEYS = ['id', 'original_username']
 OPTIONAL_IDENTIFYING_KEYS = ['ecommerce_segment_id']
 
+
+def _tuple_getter(keys):
+    """
+    Returns a callable which gets the values of these keys from a dict, always as a tuple.
+
+    operator.itemgetter returns a bare value for a single key, which callers would then iterate over.
+    """
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda item: (item[key],)
+    return operator.itemgetter(*keys)
+
+
+_REQUIRED_IDENTIFYING_VALUES = _tuple_getter(REQUIRED_IDENTIFYING_KEYS)
+
 # The Segment Config API for bulk deleting users for a particular workspace
 BULK_DELETE_URL = 'v1beta/workspaces/{}/regulations'
 
@@ -27,6 +59,28 @@ BULK_DELETE_STATUS_URL = 'v1beta/workspaces/{}/regulations/{}'
 # https://reference.segmentapis.com/?version=latest#57a69434-76cc-43cc-a547-98c319182247
 MAXIMUM_USERS_IN_DELETE_REQUEST = 5000
 
+# Bulk deletion statuses which mean Segment is still working on the request
+PENDING_BULK_DELETE_STATUSES = ('INITIALIZED', 'RUNNING')
+
+# Bulk deletion statuses which mean Segment is done with the request
+FINISHED_BULK_DELETE_STATUSES = ('FAILED', 'FINISHED', 'INVALID', 'NOT_SUPPORTED', 'PARTIAL_SUCCESS')
+
+# Bounds (in seconds) of the interval between bulk deletion status polls. The interval grows by
+# POLL_INTERVAL_INCREASE while the request is pending and doubles when Segment rate limits us.
+POLL_INTERVAL_MIN = 1.0
+POLL_INTERVAL_MAX = 60.0
+POLL_INTERVAL_INCREASE = 0.5
+
+# After this many consecutive 5xx responses, Segment calls fail fast for CIRCUIT_BREAKER_COOLDOWN seconds
+CIRCUIT_BREAKER_MAX_FAILURES = 5
+CIRCUIT_BREAKER_COOLDOWN = 60
+
+# Number of keep-alive connections kept open to the Segment API
+CONNECTION_POOL_SIZE = 16
+
+# Maximum number of bulk delete requests submitted to Segment concurrently
+MAX_CONCURRENT_REQUESTS = 8
+
 LOG = logging.getLogger(__name__)
 
 
@@ -45,11 +99,54 @@ def _backoff_handler(details):
         pass
 
 
-def _wait_30_seconds():
+def _retry_after_seconds(response):
+    """
+    Returns the number of seconds Segment asked us to wait in a Retry-After header, or None if absent.
+
+    The header may either be a number of seconds or an HTTP date.
+    """
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return max(0, int(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _segment_wait_gen():
     """
-    Backoff generator that waits for 30 seconds.
+    Backoff generator that picks how long to wait based on the exception being retried.
+
+    Rate limited (429) responses wait exactly as long as Segment's Retry-After header asks, timeouts wait
+    for 30 seconds, and everything else backs off exponentially.
     """
-    return backoff.constant(interval=30)
+    # backoff.expo() starts with a None under backoff 2.x, to absorb the priming send.
+    expo = (wait for wait in backoff.expo() if wait is not None)
+    if _BACKOFF_SENDS_EXCEPTIONS:
+        # Priming send, before any call was made: wait for backoff to send the first exception.
+        exc = yield
+    else:
+        exc = sys.exc_info()[1]
+
+    while True:
+        retry_after = None
+        if isinstance(exc, requests.exceptions.HTTPError) and exc.response.status_code == 429:
+            retry_after = _retry_after_seconds(exc.response)
+
+        if retry_after is not None:
+            wait = retry_after
+        elif isinstance(exc, requests.exceptions.Timeout):
+            wait = backoff.full_jitter(30)
+        else:
+            wait = backoff.full_jitter(next(expo))  # pylint: disable=stop-iteration-return
+
+        sent_exc = yield wait
+        exc = sent_exc if _BACKOFF_SENDS_EXCEPTIONS else sys.exc_info()[1]
 
 
 def _http_status_giveup(exc):
@@ -59,32 +156,119 @@ def _http_status_giveup(exc):
     return not 429 == exc.response.status_code and not 500 <= exc.response.status_code < 600
 
 
+def _segment_api_giveup(exc):
+    """
+    Giveup method that only gives up on HTTPErrors which should not be retried, including
+    rate limits asking us to wait longer than MAX_RETRY_AFTER_SECONDS.
+    """
+    if isinstance(exc, requests.exceptions.HTTPError):
+        if exc.response.status_code == 429:
+            retry_after = _retry_after_seconds(exc.response)
+            if retry_after is not None and retry_after > MAX_RETRY_AFTER_SECONDS:
+                LOG.error('Giving up after Segment asked to retry in {:0.1f} seconds'.format(retry_after))
+                return True
+        return _http_status_giveup(exc)
+    return False
+
+
 def _retry_segment_api():
     """
     Decorator which enables retries with sane backoff defaults
     """
-    def inner(func):  # pylint: disable=missing-docstring
-        func_with_decode_backoff = backoff.on_exception(
-            backoff.expo,
-            JSONDecodeError,
-            max_tries=MAX_TRIES,
-            on_backoff=lambda details: _backoff_handler(details)  # pylint: disable=unnecessary-lambda
-        )
-        func_with_backoff = backoff.on_exception(
-            backoff.expo,
-            requests.exceptions.HTTPError,
-            max_tries=MAX_TRIES,
-            giveup=_http_status_giveup,
-            on_backoff=lambda details: _backoff_handler(details)  # pylint: disable=unnecessary-lambda
-        )
-        func_with_timeout_backoff = backoff.on_exception(
-            _wait_30_seconds,
-            requests.exceptions.Timeout,
-            max_tries=MAX_TRIES,
-            on_backoff=lambda details: _backoff_handler(details)  # pylint: disable=unnecessary-lambda
-        )
-        return func_with_decode_backoff(func_with_backoff(func_with_timeout_backoff(func)))
-    return inner
+    return backoff.on_exception(
+        _segment_wait_gen,
+        (JSONDecodeError, requests.exceptions.HTTPError, requests.exceptions.Timeout),
+        max_tries=MAX_TRIES,
+        giveup=_segment_api_giveup,
+        jitter=None,  # Jitter is applied by _segment_wait_gen, except to Retry-After waits.
+        on_backoff=lambda details: _backoff_handler(details)  # pylint: disable=unnecessary-lambda
+    )
+
+
+def _chunk_indices(num_learners, chunk_size, beginning_idx=0):
+    """
+    Splits learners into chunks for bulk deletion.
+
+    :return: List of (start_idx, end_idx) tuples, both indices inclusive.
+    """
+    return [
+        (start_idx, min(start_idx + chunk_size - 1, num_learners - 1))
+        for start_idx in range(beginning_idx, num_learners, chunk_size)
+    ]
+
+
+def _build_delete_payload(batch):
+    """
+    Builds the Segment bulk deletion request body for a chunk of learners.
+
+    :param batch: List of learner dicts returned from LMS which make up this chunk.
+    :return: Bulk deletion request body, with every identifying value of these learners.
+    """
+    learner_vals = []
+    add_vals = learner_vals.extend
+    for learner in batch:
+        add_vals(map(str, _REQUIRED_IDENTIFYING_VALUES(learner)))
+        add_vals(str(learner[id_key]) for id_key in OPTIONAL_IDENTIFYING_KEYS if id_key in learner)
+
+    return {
+        "regulation_type": "Suppress_With_Delete",
+        "attributes": {
+            "name": "userId",
+            "values": learner_vals
+        }
+    }
+
+
+def _idempotency_key(workspace_slug, learner_vals):
+    """
+    Returns a key which deterministically identifies a bulk deletion of these values from this workspace.
+    """
+    key_source = '|'.join([workspace_slug] + sorted(learner_vals))
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+class SegmentCircuitOpen(Exception):
+    """
+    Raised instead of calling Segment after CIRCUIT_BREAKER_MAX_FAILURES consecutive server errors
+    have tripped the circuit breaker.
+    """
+
+
+class _CircuitBreaker:
+    """
+    Tracks consecutive Segment server errors, failing calls fast while Segment appears to be down.
+
+    Shared by all the threads submitting chunks for a SegmentApi, so all state changes are locked.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    def check(self):
+        """
+        Raises SegmentCircuitOpen if the breaker is open and still cooling down.
+        """
+        with self._lock:
+            if self._opened_at is not None and time.monotonic() - self._opened_at < CIRCUIT_BREAKER_COOLDOWN:
+                raise SegmentCircuitOpen(
+                    'Not calling Segment after {} consecutive server errors'.format(self._failures)
+                )
+
+    def record(self, status_code):
+        """
+        Records the status of a Segment response, opening the breaker after too many server errors.
+
+        Once the cooldown has passed calls are let through again, and a single further server error reopens it.
+        """
+        with self._lock:
+            if 500 <= status_code < 600:
+                self._failures += 1
+                if self._failures >= CIRCUIT_BREAKER_MAX_FAILURES:
+                    self._opened_at = time.monotonic()
+            else:
+                self._failures = 0
+                self._opened_at = None
 
 
 class SegmentApi:
@@ -95,20 +279,40 @@ class SegmentApi:
         self.base_url = base_url
         self.auth_token = auth_token
         self.workspace_slug = workspace_slug
+        self._bulk_delete_url = BULK_DELETE_URL.format(workspace_slug)
+        self._bulk_delete_status_url = BULK_DELETE_STATUS_URL.format(workspace_slug, '{}')
+
+        # Reuse connections across calls to avoid a new TCP/TLS handshake per request.
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = "Bearer {}".format(auth_token)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=CONNECTION_POOL_SIZE,
+            pool_maxsize=CONNECTION_POOL_SIZE
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._post_headers = {
+            "Content-Type": "application/json"
+        }
+        self._circuit_breaker = _CircuitBreaker()
 
     @_retry_segment_api()
-    def _call_segment_post(self, url, params):
+    def _call_segment_post(self, url, body, idempotency_key=None):
         """
-        Actually makes the Segment REST POST call.
+        Actually makes the Segment REST POST call with an already JSON-encoded body.
 
         5xx errors and timeouts will be retried via _retry_segment_api,
-        all others will bubble up.
+        all others will bubble up. Retries reuse the same idempotency_key,
+        so a retried request cannot be applied twice. SegmentCircuitOpen is
+        raised without calling Segment while the circuit breaker is open.
         """
-        headers = {
-            "Authorization": "Bearer {}".format(self.auth_token),
-            "Content-Type": "application/json"
-        }
-        resp = requests.post(self.base_url + url, json=params, headers=headers)
+        self._circuit_breaker.check()
+        headers = self._post_headers
+        if idempotency_key:
+            # Copy, since concurrent chunk submissions share self._post_headers.
+            headers = dict(headers, **{"Idempotency-Key": idempotency_key})
+        resp = self.session.post(self.base_url + url, data=body, headers=headers)
+        self._circuit_breaker.record(resp.status_code)
         resp.raise_for_status()
         return resp
 
@@ -118,12 +322,12 @@ class SegmentApi:
         Actually makes the Segment REST GET call.
 
         5xx errors and timeouts will be retried via _retry_segment_api,
-        all others will bubble up.
+        all others will bubble up. SegmentCircuitOpen is raised without
+        calling Segment while the circuit breaker is open.
         """
-        headers = {
-            "Authorization": "Bearer {}".format(self.auth_token)
-        }
-        resp = requests.get(self.base_url + url, headers=headers)
+        self._circuit_breaker.check()
+        resp = self.session.get(self.base_url + url)
+        self._circuit_breaker.record(resp.status_code)
         resp.raise_for_status()
         return resp
 
@@ -140,77 +344,161 @@ class SegmentApi:
         """
         Sets up the Segment REST API calls to GDPR-delete users in chunks.
 
+        Up to MAX_CONCURRENT_REQUESTS chunks are submitted at once, in order. Once a chunk fails, chunks
+        which have not started yet are cancelled, and the error of the earliest failed chunk is raised
+        after the chunks already in flight finish. Every chunk before that one was queued in Segment, so
+        the run can be resumed by passing its start index as beginning_idx. Up to
+        MAX_CONCURRENT_REQUESTS - 1 later chunks may also have been queued already.
+
         :param learners: List of learner dicts returned from LMS, should contain all we need to retire this learner.
         :param chunk_size: How many learners should be retired in this batch.
         :param beginning_idx: Index into learners where this batch should start.
         """
-        curr_idx = beginning_idx
-        while curr_idx < len(learners):
-            start_idx = curr_idx
-            end_idx = min(start_idx + chunk_size - 1, len(learners) - 1)
+        # Every learner contributes at most one value per identifying key, so the largest chunk is
+        # known up front and too-large requests can be rejected before any of them are built.
+        max_vals_per_chunk = min(chunk_size, len(learners) - beginning_idx) * (
+            len(REQUIRED_IDENTIFYING_KEYS) + len(OPTIONAL_IDENTIFYING_KEYS)
+        )
+        if max_vals_per_chunk >= MAXIMUM_USERS_IN_DELETE_REQUEST:
+            LOG.error(
+                'Attempting to delete too many user values (up to %s) at once in bulk request - decrease chunk_size.',
+                max_vals_per_chunk
+            )
+            return
+
+        chunks = []
+        for start_idx, end_idx in _chunk_indices(len(learners), chunk_size, beginning_idx):
+            batch = learners[start_idx:end_idx + 1]
             LOG.info(
                 "Attempting Segment deletion with start index %s, end index %s for learners (%s, %s) through (%s, %s)",
                 start_idx, end_idx,
-                learners[start_idx]['id'], learners[start_idx]['original_username'],
-                learners[end_idx]['id'], learners[end_idx]['original_username']
+                batch[0]['id'], batch[0]['original_username'],
+                batch[-1]['id'], batch[-1]['original_username']
             )
 
-            learner_vals = []
-            for idx in range(start_idx, end_idx + 1):
-                for id_key in REQUIRED_IDENTIFYING_KEYS:
-                    learner_vals.append(text_type(learners[idx][id_key]))
-                for id_key in OPTIONAL_IDENTIFYING_KEYS:
-                    if id_key in learners[idx]:
-                        learner_vals.append(text_type(learners[idx][id_key]))
-
-            if len(learner_vals) >= MAXIMUM_USERS_IN_DELETE_REQUEST:
-                LOG.error(
-                    'Attempting to delete too many user values (%s) at once in bulk request - decrease chunk_size.',
-                    len(learner_vals)
-                )
-                return
+            params = _build_delete_payload(batch)
+            learner_vals = params['attributes']['values']
+
+            # Encode the body once, rather than on every attempt to submit it.
+            body = json.dumps(params, separators=(',', ':')).encode('utf-8')
+            chunks.append((start_idx, end_idx, body, _idempotency_key(self.workspace_slug, learner_vals)))
 
-            params = {
-                "regulation_type": "Suppress_With_Delete",
-                "attributes": {
-                    "name": "userId",
-                    "values": learner_vals
-                }
-            }
+        if not chunks:
+            return
 
-            resp_json = ""
+        chunk_failed = threading.Event()
 
+        def submit_chunk(chunk):
+            """
+            Submits a chunk, unless another chunk has already failed.
+            """
+            if chunk_failed.is_set():
+                return
             try:
-                resp = self._call_segment_post(BULK_DELETE_URL.format(self.workspace_slug), params)
-                try:
-                    resp_json = resp.json()
-                    bulk_user_delete_id = resp_json['regulate_id']
-                    LOG.info('Bulk user deletion queued. Id: {}'.format(bulk_user_delete_id))
-                except JSONDecodeError:
-                    resp_json = resp.text
-                    raise
+                self._submit_bulk_delete(*chunk)
+            except Exception:
+                chunk_failed.set()
+                raise
+
+        # Each chunk is an independent network-bound request, so submit them concurrently.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(chunks))) as executor:
+            futures = [executor.submit(submit_chunk, chunk) for chunk in chunks]
+            _, not_done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in not_done:
+                future.cancel()
+
+        # Workers start chunks in order, so every chunk before the earliest failure has finished.
+        for future in futures:
+            if not future.cancelled():
+                future.result()
+
+    def _submit_bulk_delete(self, start_idx, end_idx, body, idempotency_key):
+        """
+        Submits a single chunk of learners to the Segment bulk deletion REST API.
 
-            # If we get here we got some kind of JSON response from Segment, we'll try to get
-            # the data we need. If it doesn't exist we'll bubble up the error from Segment and
-            # eat the TypeError / KeyError since they won't be relevant.
-            except (TypeError, KeyError, requests.exceptions.HTTPError, JSONDecodeError) as exc:
-                LOG.exception(exc)
-                err = u'Error was encountered for learners between start/end indices ({}, {}) : {}'.format(
-                    start_idx, end_idx,
-                    text_type(resp_json)
-                ).encode('utf-8')
-                LOG.error(err)
+        :param start_idx: Index of the first learner in this chunk, used for error reporting.
+        :param end_idx: Index of the last learner in this chunk, used for error reporting.
+        :param body: JSON-encoded bulk deletion request body for this chunk.
+        :param idempotency_key: Key identifying this chunk, sent with every attempt to submit it.
+        :return: The ID of the queued bulk deletion request.
+        """
+        resp_json = ""
+
+        try:
+            resp = self._call_segment_post(self._bulk_delete_url, body, idempotency_key)
+            try:
+                resp_json = resp.json()
+                bulk_user_delete_id = resp_json['regulate_id']
+                LOG.info('Bulk user deletion queued. Id: {}'.format(bulk_user_delete_id))
+            except JSONDecodeError:
+                resp_json = resp.text
+                raise
+
+        # If we get here we got some kind of JSON response from Segment, we'll try to get
+        # the data we need. If it doesn't exist we'll bubble up the error from Segment and
+        # eat the TypeError / KeyError since they won't be relevant.
+        except (TypeError, KeyError, requests.exceptions.HTTPError, JSONDecodeError, SegmentCircuitOpen) as exc:
+            LOG.exception(exc)
+            err = u'Error was encountered for learners between start/end indices ({}, {}) : {}'.format(
+                start_idx, end_idx,
+                str(resp_json)
+            ).encode('utf-8')
+            LOG.error(err)
 
-                raise Exception(err)
+            raise Exception(err)
 
-            curr_idx += chunk_size
+        return bulk_user_delete_id
 
     def get_bulk_delete_status(self, bulk_delete_id):
         """
         Queries the status of a previously submitted bulk delete request.
 
         :param bulk_delete_id: ID returned from a previously-submitted bulk delete request.
+        :return: Parsed json of the bulk delete status.
         """
-        resp = self._call_segment_get(BULK_DELETE_STATUS_URL.format(self.workspace_slug, bulk_delete_id))
+        resp = self._call_segment_get(self._bulk_delete_status_url.format(bulk_delete_id))
         resp_json = resp.json()
-        LOG.info(text_type(resp_json))
+        LOG.info(str(resp_json))
+        return resp_json
+
+    def wait_for_bulk_delete(self, bulk_delete_id, max_wait=3600):
+        """
+        Polls the status of a previously submitted bulk delete request until Segment reports one of
+        FINISHED_BULK_DELETE_STATUSES.
+
+        The poll interval grows linearly while the request is pending, and doubles (honoring Retry-After,
+        up to MAX_RETRY_AFTER_SECONDS) when Segment rate limits the status calls.
+
+        :param bulk_delete_id: ID returned from a previously-submitted bulk delete request.
+        :param max_wait: How many seconds to wait for the request to finish before throwing an error.
+        :return: Parsed json of the final bulk delete status.
+        :raises TimeoutException: When the request does not finish within max_wait seconds.
+        :raises BackendDataError: When Segment returns a missing or unknown status.
+        """
+        url = self._bulk_delete_status_url.format(bulk_delete_id)
+        end_time = time.monotonic() + max_wait
+        interval = POLL_INTERVAL_MIN
+        while True:
+            try:
+                resp_json = self._call_segment_get(url).json()
+            except requests.exceptions.HTTPError as exc:
+                if exc.response.status_code != 429:
+                    raise
+                interval = min(POLL_INTERVAL_MAX, interval * 2)
+                retry_after = _retry_after_seconds(exc.response) or 0
+                wait = max(interval, min(retry_after, MAX_RETRY_AFTER_SECONDS))
+            else:
+                status = resp_json.get('overall_status')
+                if status in FINISHED_BULK_DELETE_STATUSES:
+                    LOG.info('Bulk user deletion {} finished with status {}'.format(bulk_delete_id, status))
+                    return resp_json
+                if status not in PENDING_BULK_DELETE_STATUSES:
+                    raise BackendDataError(
+                        'Unexpected status {} for bulk user deletion {}: {}'.format(status, bulk_delete_id, resp_json)
+                    )
+                wait = interval
+                interval = min(POLL_INTERVAL_MAX, interval + POLL_INTERVAL_INCREASE)
+
+            if time.monotonic() + wait > end_time:
+                raise TimeoutException("Timed out while waiting for bulk user deletion {}".format(bulk_delete_id))
+            time.sleep(wait)
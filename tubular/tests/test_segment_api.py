@@ -1,14 +1,21 @@
 """
 Tests for the Segment API functionality
 """
+import hashlib
 import json
+import time
 import mock
 import pytest
 
 import requests
 from six import text_type
 
-from tubular.segment_api import SegmentApi, BULK_DELETE_URL
+from tubular.exception import BackendDataError, TimeoutException
+from tubular.segment_api import (
+    SegmentApi, SegmentCircuitOpen, BULK_DELETE_URL, CIRCUIT_BREAKER_MAX_FAILURES, MAX_CONCURRENT_REQUESTS,
+    MAX_RETRY_AFTER_SECONDS, MAX_TRIES,
+    _build_delete_payload, _retry_segment_api, _tuple_getter
+)
 
 
 FAKE_AUTH_TOKEN = 'FakeToken'
@@ -18,7 +25,7 @@ TEST_SEGMENT_CONFIG = {
     'fake_base_url': 'https://segment.invalid/',
     'fake_auth_token': FAKE_AUTH_TOKEN,
     'fake_workspace': 'FakeEdx',
-    'headers': {"Authorization": "Bearer {}".format(FAKE_AUTH_TOKEN), "Content-Type": "application/json"}
+    'headers': {"Content-Type": "application/json"}
 }
 
 
@@ -26,6 +33,8 @@ class FakeResponse:
     """
     Fakes out requests.post response
     """
+    status_code = 200
+
     def json(self):
         """
         Returns fake Segment retirement response data in the correct format
@@ -58,7 +67,7 @@ def setup_bulk_delete():
     """
     Fixture to setup common bulk delete items.
     """
-    with mock.patch('requests.post') as mock_post:
+    with mock.patch('requests.Session.post') as mock_post:
         segment = SegmentApi(
             *[TEST_SEGMENT_CONFIG[key] for key in [
                 'fake_base_url', 'fake_auth_token', 'fake_workspace'
@@ -93,10 +102,17 @@ def test_bulk_delete_success(setup_bulk_delete):  # pylint: disable=redefined-ou
         }
     }
 
+    idempotency_key = hashlib.sha256(
+        '|'.join([TEST_SEGMENT_CONFIG['fake_workspace']] + sorted(learners_vals)).encode('utf-8')
+    ).hexdigest()
+    headers = dict(TEST_SEGMENT_CONFIG['headers'], **{'Idempotency-Key': idempotency_key})
+
     url = TEST_SEGMENT_CONFIG['fake_base_url'] + BULK_DELETE_URL.format(TEST_SEGMENT_CONFIG['fake_workspace'])
     mock_post.assert_any_call(
-        url, json=fake_json, headers=TEST_SEGMENT_CONFIG['headers']
+        url, data=mock.ANY, headers=headers
     )
+    assert json.loads(mock_post.call_args[1]['data'].decode('utf-8')) == fake_json
+    assert segment.session.headers['Authorization'] == "Bearer {}".format(FAKE_AUTH_TOKEN)
 
 
 def test_bulk_delete_error(setup_bulk_delete, caplog):  # pylint: disable=redefined-outer-name
@@ -111,5 +127,318 @@ def test_bulk_delete_error(setup_bulk_delete, caplog):  # pylint: disable=redefi
         segment.delete_learners(learner, 1000)
 
     assert mock_post.call_count == 4
+    # Every retry of the chunk is sent with the same idempotency key.
+    assert len({call[1]['headers']['Idempotency-Key'] for call in mock_post.call_args_list}) == 1
     assert "Error was encountered for learners between start/end indices (0, 0)" in caplog.text
     assert "{'error': 'Test error message'}" in caplog.text
+
+
+def test_bulk_delete_multiple_chunks(setup_bulk_delete):  # pylint: disable=redefined-outer-name
+    """
+    Test that each chunk of learners is submitted in its own request
+    """
+    mock_post, segment = setup_bulk_delete
+    mock_post.return_value = FakeResponse()
+
+    learners = [
+        {
+            'id': idx,
+            'ecommerce_segment_id': 'ecommerce-{}'.format(idx),
+            'original_username': 'test_user_{}'.format(idx)
+        }
+        for idx in range(5)
+    ]
+    segment.delete_learners(learners, 2)
+
+    assert mock_post.call_count == 3
+    submitted_vals = sorted(
+        json.loads(call[1]['data'].decode('utf-8'))['attributes']['values'] for call in mock_post.call_args_list
+    )
+    assert submitted_vals == [
+        ['0', 'test_user_0', 'ecommerce-0', '1', 'test_user_1', 'ecommerce-1'],
+        ['2', 'test_user_2', 'ecommerce-2', '3', 'test_user_3', 'ecommerce-3'],
+        ['4', 'test_user_4', 'ecommerce-4'],
+    ]
+
+
+def test_bulk_delete_circuit_breaker(setup_bulk_delete, caplog):  # pylint: disable=redefined-outer-name
+    """
+    Test that repeated server errors stop further Segment calls until the cooldown has passed
+    """
+    mock_post, segment = setup_bulk_delete
+    mock_post.return_value = FakeErrorResponse()
+
+    learner = TEST_SEGMENT_CONFIG['learner']
+    with mock.patch('time.sleep'):
+        for _ in range(3):
+            with pytest.raises(Exception):
+                segment.delete_learners(learner, 1000)
+
+    assert mock_post.call_count == CIRCUIT_BREAKER_MAX_FAILURES
+    assert "Not calling Segment after {} consecutive server errors".format(
+        CIRCUIT_BREAKER_MAX_FAILURES
+    ) in caplog.text
+    with pytest.raises(SegmentCircuitOpen):
+        segment._call_segment_get('fake_url')  # pylint: disable=protected-access
+
+    mock_post.reset_mock()
+    mock_post.return_value = FakeResponse()
+    with mock.patch('time.monotonic', return_value=time.monotonic() + 60):
+        segment.delete_learners(learner, 1000)
+    assert mock_post.call_count == 1
+
+
+def test_build_delete_payload():
+    """
+    Test that every learner's values are included, skipping missing optional keys
+    """
+    learners = [
+        {'id': 2, 'original_username': 'test_user_2'},
+        {'id': 3, 'original_username': 'test_user_3', 'ecommerce_segment_id': 'ecommerce-3'},
+    ]
+
+    assert _build_delete_payload(learners) == {
+        "regulation_type": "Suppress_With_Delete",
+        "attributes": {
+            "name": "userId",
+            "values": ['2', 'test_user_2', '3', 'test_user_3', 'ecommerce-3']
+        }
+    }
+
+
+def test_bulk_delete_stops_after_failed_chunk(setup_bulk_delete, caplog):  # pylint: disable=redefined-outer-name
+    """
+    Test that chunks which have not started yet are not submitted once a chunk fails
+    """
+    mock_post, segment = setup_bulk_delete
+
+    def fake_post(url, data, headers):  # pylint: disable=unused-argument
+        """
+        Fails the first chunk, while the other chunks in flight take a while to succeed.
+        """
+        if json.loads(data.decode('utf-8'))['attributes']['values'][0] == '0':
+            response = FakeErrorResponse()
+            response.status_code = 400
+            return response
+        time.sleep(0.5)
+        return FakeResponse()
+
+    mock_post.side_effect = fake_post
+    learners = [{'id': idx, 'original_username': 'test_user_{}'.format(idx)} for idx in range(20)]
+    with pytest.raises(Exception):
+        segment.delete_learners(learners, 1)
+
+    # Only the chunks already in flight when the first chunk failed were submitted.
+    assert 1 <= mock_post.call_count <= MAX_CONCURRENT_REQUESTS
+    assert "Error was encountered for learners between start/end indices (0, 0)" in caplog.text
+
+
+@pytest.mark.parametrize('keys, expected_values', [
+    (['original_username'], ('test_user',)),
+    (['id', 'original_username'], (1, 'test_user')),
+])
+def test_tuple_getter(keys, expected_values):
+    """
+    Test that identifying values are always returned as a tuple, even for a single key
+    """
+    assert _tuple_getter(keys)(TEST_SEGMENT_CONFIG['learner'][0]) == expected_values
+
+
+def test_bulk_delete_too_many_values(setup_bulk_delete, caplog):  # pylint: disable=redefined-outer-name
+    """
+    Test that chunks which could exceed Segment's value limit are rejected before anything is submitted
+    """
+    mock_post, segment = setup_bulk_delete
+    mock_post.return_value = FakeResponse()
+
+    learners = TEST_SEGMENT_CONFIG['learner'] * 2000
+    segment.delete_learners(learners, 2000)
+
+    assert mock_post.call_count == 0
+    assert 'Attempting to delete too many user values (up to 6000)' in caplog.text
+
+
+@pytest.mark.parametrize('exc, expected_calls', [
+    (requests.exceptions.Timeout(), MAX_TRIES),
+    (requests.exceptions.HTTPError("", response=FakeErrorResponse()), MAX_TRIES),
+    (requests.exceptions.HTTPError("", response=mock.Mock(status_code=400)), 1),
+])
+def test_retry_segment_api(exc, expected_calls):
+    """
+    Test that timeouts and retryable HTTP errors are retried, and others give up immediately
+    """
+    failing_call = mock.Mock(side_effect=exc, __name__='failing_call')
+    with mock.patch('time.sleep'):
+        with pytest.raises(type(exc)):
+            _retry_segment_api()(failing_call)()
+
+    assert failing_call.call_count == expected_calls
+
+
+@pytest.mark.parametrize('outer_exc', [
+    requests.exceptions.Timeout(),
+    requests.exceptions.HTTPError("", response=mock.Mock(status_code=429, headers={'Retry-After': '7'})),
+])
+def test_retry_ignores_outer_exception(outer_exc):
+    """
+    Test that waits are based on the retried exception, not one being handled by the caller
+    """
+    server_error = requests.exceptions.HTTPError("", response=FakeErrorResponse())
+    failing_call = mock.Mock(side_effect=[server_error, server_error, 'success'], __name__='failing_call')
+    with mock.patch('time.sleep') as mock_sleep:
+        with mock.patch('random.uniform', side_effect=lambda low, high: high):
+            try:
+                raise outer_exc
+            except type(outer_exc):
+                assert _retry_segment_api()(failing_call)() == 'success'
+
+    assert [call[0][0] for call in mock_sleep.call_args_list] == [1, 2]
+
+
+@pytest.mark.parametrize('retry_after, expected_wait', [
+    ('7', 7),
+    ('Wed, 21 Oct 2015 07:28:07 GMT', 7),
+])
+def test_retry_after_honored(retry_after, expected_wait):
+    """
+    Test that rate limited calls wait as long as Segment's Retry-After header asks
+    """
+    response = mock.Mock(status_code=429, headers={'Retry-After': retry_after})
+    failing_call = mock.Mock(
+        side_effect=[requests.exceptions.HTTPError("", response=response), 'success'],
+        __name__='failing_call'
+    )
+    with mock.patch('time.sleep') as mock_sleep:
+        with mock.patch('time.time', return_value=1445412480):  # Wed, 21 Oct 2015 07:28:00 GMT
+            assert _retry_segment_api()(failing_call)() == 'success'
+
+    mock_sleep.assert_called_once_with(expected_wait)
+
+
+class FakeStatusResponse:
+    """
+    Fakes a Segment bulk delete status response
+    """
+    def __init__(self, status_code=200, overall_status='RUNNING', headers=None):
+        self.status_code = status_code
+        self.overall_status = overall_status
+        self.headers = headers or {}
+        self.text = ''
+
+    def json(self):
+        """
+        Returns fake Segment bulk delete status data in the correct format
+        """
+        return {'id': 'fake_id', 'overall_status': self.overall_status}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError("", response=self)
+
+
+@pytest.fixture
+def setup_bulk_delete_status():
+    """
+    Fixture to setup common bulk delete status polling items.
+    """
+    with mock.patch('requests.Session.get') as mock_get:
+        with mock.patch('time.sleep') as mock_sleep:
+            segment = SegmentApi(
+                *[TEST_SEGMENT_CONFIG[key] for key in [
+                    'fake_base_url', 'fake_auth_token', 'fake_workspace'
+                ]]
+            )
+
+            yield mock_get, mock_sleep, segment
+
+
+def test_wait_for_bulk_delete(setup_bulk_delete_status):  # pylint: disable=redefined-outer-name
+    """
+    Test that polling backs off additively until the bulk delete finishes
+    """
+    mock_get, mock_sleep, segment = setup_bulk_delete_status
+    mock_get.side_effect = [
+        FakeStatusResponse(overall_status='INITIALIZED'),
+        FakeStatusResponse(overall_status='RUNNING'),
+        FakeStatusResponse(overall_status='RUNNING'),
+        FakeStatusResponse(overall_status='FINISHED'),
+    ]
+
+    resp_json = segment.wait_for_bulk_delete('fake_id')
+
+    assert resp_json['overall_status'] == 'FINISHED'
+    assert [call[0][0] for call in mock_sleep.call_args_list] == [1.0, 1.5, 2.0]
+
+
+def test_wait_for_bulk_delete_rate_limited(setup_bulk_delete_status):  # pylint: disable=redefined-outer-name
+    """
+    Test that polling slows down and honors Retry-After when Segment keeps rate limiting us
+    """
+    mock_get, mock_sleep, segment = setup_bulk_delete_status
+    mock_get.side_effect = [FakeStatusResponse(status_code=429, headers={'Retry-After': '10'})] * MAX_TRIES + [
+        FakeStatusResponse(overall_status='RUNNING'),
+        FakeStatusResponse(overall_status='FINISHED'),
+    ]
+
+    resp_json = segment.wait_for_bulk_delete('fake_id')
+
+    assert resp_json['overall_status'] == 'FINISHED'
+    # Retries inside the Segment API call, then the poller's own wait, then the doubled poll interval.
+    assert [call[0][0] for call in mock_sleep.call_args_list] == [10] * (MAX_TRIES - 1) + [10, 2.0]
+
+
+def test_retry_after_too_long_gives_up():
+    """
+    Test that calls are not retried when Segment asks us to wait longer than MAX_RETRY_AFTER_SECONDS
+    """
+    response = mock.Mock(status_code=429, headers={'Retry-After': str(MAX_RETRY_AFTER_SECONDS + 1)})
+    failing_call = mock.Mock(
+        side_effect=requests.exceptions.HTTPError("", response=response), __name__='failing_call'
+    )
+    with mock.patch('time.sleep') as mock_sleep:
+        with pytest.raises(requests.exceptions.HTTPError):
+            _retry_segment_api()(failing_call)()
+
+    assert failing_call.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+def test_wait_for_bulk_delete_retry_after_capped(setup_bulk_delete_status):  # pylint: disable=redefined-outer-name
+    """
+    Test that polling waits at most MAX_RETRY_AFTER_SECONDS, however long Segment asks us to wait
+    """
+    mock_get, mock_sleep, segment = setup_bulk_delete_status
+    mock_get.side_effect = [
+        FakeStatusResponse(status_code=429, headers={'Retry-After': '86400'}),
+        FakeStatusResponse(overall_status='FINISHED'),
+    ]
+
+    resp_json = segment.wait_for_bulk_delete('fake_id', max_wait=86400)
+
+    assert resp_json['overall_status'] == 'FINISHED'
+    mock_sleep.assert_called_once_with(MAX_RETRY_AFTER_SECONDS)
+
+
+@pytest.mark.parametrize('overall_status', [None, 'SOMETHING_NEW'])
+def test_wait_for_bulk_delete_unexpected_status(
+        setup_bulk_delete_status, overall_status
+):  # pylint: disable=redefined-outer-name
+    """
+    Test that polling does not treat a missing or unknown status as finished
+    """
+    mock_get, _, segment = setup_bulk_delete_status
+    mock_get.return_value = FakeStatusResponse(overall_status=overall_status)
+
+    with pytest.raises(BackendDataError):
+        segment.wait_for_bulk_delete('fake_id')
+
+
+def test_wait_for_bulk_delete_timeout(setup_bulk_delete_status):  # pylint: disable=redefined-outer-name
+    """
+    Test that polling gives up once max_wait is exceeded
+    """
+    mock_get, _, segment = setup_bulk_delete_status
+    mock_get.return_value = FakeStatusResponse(overall_status='RUNNING')
+
+    with pytest.raises(TimeoutException):
+        segment.wait_for_bulk_delete('fake_id', max_wait=0)